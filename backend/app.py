@@ -1,13 +1,18 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import os
+import hmac
+import threading
+import time
 from dotenv import load_dotenv
 import requests
 import re
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
 import json
+import click
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from google.cloud import bigquery
 
 # Load environment variables
@@ -49,19 +54,288 @@ except Exception as e:
     print(f"Firestore initialization failed: {e}")
     db = None
 
+# Meal dates: `created_at` is a UTC timestamp and `day` is the YYYY-MM-DD day
+# in the user's profile timezone when the meal was logged
+UTC = ZoneInfo('UTC')
+DEFAULT_TIMEZONE = 'UTC'
+
+# Firestore meal queries. The composite indexes in firestore.indexes.json are
+# generated from these specs (`flask firestore-indexes`), so new meal queries
+# belong here rather than being built inline.
+MEAL_QUERIES = {
+    # Meals on one user-local day (summaries, recommendations)
+    'meals_for_day': {
+        'equality': ['user_id', 'day'],
+        'order_by': []
+    },
+    # Meals over a range of user-local days, newest first
+    'meals_in_day_range': {
+        'equality': ['user_id'],
+        'range': 'day',
+        'order_by': [('day', 'DESCENDING'), ('created_at', 'DESCENDING')]
+    },
+    # All of a user's meals, newest first
+    'recent_meals': {
+        'equality': ['user_id'],
+        'order_by': [('created_at', 'DESCENDING')]
+    }
+}
+FIRESTORE_INDEXES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'firestore.indexes.json')
+
+def build_meal_query(name, start=None, end=None, **values):
+    """Build a Firestore query on `meals` from a MEAL_QUERIES spec"""
+    spec = MEAL_QUERIES[name]
+    query = db.collection('meals')
+    for field in spec['equality']:
+        query = query.where(field, '==', values[field])
+    if spec.get('range'):
+        if start:
+            query = query.where(spec['range'], '>=', start)
+        if end:
+            query = query.where(spec['range'], '<=', end)
+    for field, direction in spec['order_by']:
+        query = query.order_by(field, direction=direction)
+    return query
+
+def firestore_index_config():
+    """Composite index definitions (firestore.indexes.json format) required by MEAL_QUERIES"""
+    indexes = []
+    for spec in MEAL_QUERIES.values():
+        fields = [(field, 'ASCENDING') for field in spec['equality']]
+        ordered_fields = [field for field, _ in spec['order_by']]
+        if spec.get('range') and spec['range'] not in ordered_fields:
+            fields.append((spec['range'], 'ASCENDING'))
+        fields += spec['order_by']
+        # Single-field indexes are created automatically by Firestore
+        if len(fields) < 2:
+            continue
+        index = {
+            'collectionGroup': 'meals',
+            'queryScope': 'COLLECTION',
+            'fields': [{'fieldPath': field, 'order': direction} for field, direction in fields]
+        }
+        if index not in indexes:
+            indexes.append(index)
+    return {'indexes': indexes, 'fieldOverrides': []}
+
+def parse_day(value):
+    """Validate a YYYY-MM-DD day key, raising ValueError otherwise"""
+    return datetime.strptime(value, '%Y-%m-%d').date().isoformat()
+
 # Edamam API Configuration
 EDAMAM_APP_ID = os.getenv('EDAMAM_APP_ID')
 EDAMAM_APP_KEY = os.getenv('EDAMAM_APP_KEY')
 
+# BigQuery Configuration (shared by the nutrition lookup and meal history tables)
+BIGQUERY_PROJECT_ID = os.getenv('BIGQUERY_PROJECT_ID', 'nutrition-463318')
+BIGQUERY_DATASET_ID = os.getenv('BIGQUERY_DATASET_ID', 'nutrition_data')
+
+# Historical analytics configuration
+ANALYTICS_EXPORT_TOKEN = os.getenv('ANALYTICS_EXPORT_TOKEN')
+ANALYTICS_CACHE_TTL_SECONDS = int(os.getenv('ANALYTICS_CACHE_TTL_SECONDS', '3600'))
+# Meals newer than this are left for the next export, so a log_meal request still
+# doing its nutrition lookups has committed its meal before the watermark passes it
+ANALYTICS_EXPORT_LAG_SECONDS = int(os.getenv('ANALYTICS_EXPORT_LAG_SECONDS', '600'))
+ANALYTICS_WINDOWS = {
+    '30d': 30,
+    '90d': 90,
+    '180d': 180,
+    '365d': 365
+}
+
+# Rate limiting configuration for expensive (BigQuery-backed) endpoints.
+# log_meal is charged one token per food item, since each item is a BigQuery lookup.
+# Buckets live in process memory: with N workers/instances the effective global
+# limit is N times RATE_LIMIT_GLOBAL_*. Per-user buckets are keyed on the verified
+# Firebase uid, or on the client address for unauthenticated requests.
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv('RATE_LIMIT_USER_PER_MINUTE', '60'))
+RATE_LIMIT_USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', '20'))
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv('RATE_LIMIT_GLOBAL_PER_SECOND', '20'))
+RATE_LIMIT_GLOBAL_BURST = int(os.getenv('RATE_LIMIT_GLOBAL_BURST', '100'))
+MAX_FOOD_ITEMS_PER_MEAL = int(os.getenv('MAX_FOOD_ITEMS_PER_MEAL', '10'))
+
+if RATE_LIMIT_USER_PER_MINUTE <= 0 or RATE_LIMIT_GLOBAL_PER_SECOND <= 0:
+    raise ValueError('RATE_LIMIT_USER_PER_MINUTE and RATE_LIMIT_GLOBAL_PER_SECOND must be greater than 0')
+if min(RATE_LIMIT_USER_BURST, RATE_LIMIT_GLOBAL_BURST) < MAX_FOOD_ITEMS_PER_MEAL or MAX_FOOD_ITEMS_PER_MEAL < 1:
+    # Otherwise a maximum-size meal could never be logged
+    raise ValueError('RATE_LIMIT_*_BURST must be at least MAX_FOOD_ITEMS_PER_MEAL, which must be at least 1')
+
+class Counters:
+    """Thread-safe named counters, exposed through /api/metrics"""
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+metrics = Counters()
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller runs the
+    function, later callers wait for and share its result (or exception).
+    """
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+
+        if not is_leader:
+            metrics.increment(f'{self.name}_coalesced')
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        metrics.increment(f'{self.name}_executed')
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second up to `capacity`"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until_available(self, tokens):
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+class RateLimiter:
+    """Per-user and global token buckets for one endpoint"""
+    MAX_TRACKED_USERS = 10000
+
+    def __init__(self, name, user_rate, user_burst, global_rate, global_burst):
+        self.name = name
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self._user_buckets = {}
+        self._lock = threading.Lock()
+
+    def _prune_idle_users(self, now):
+        # Buckets that have refilled completely hold no state worth keeping
+        for user_id, bucket in list(self._user_buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._user_buckets[user_id]
+
+    def acquire(self, user_id, tokens=1):
+        """
+        Take `tokens` from both the user's bucket and the global bucket.
+        Returns (allowed, retry_after_seconds); nothing is taken unless both allow it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            user_bucket = self._user_buckets.get(user_id)
+            if user_bucket is None:
+                if len(self._user_buckets) >= self.MAX_TRACKED_USERS:
+                    self._prune_idle_users(now)
+                user_bucket = TokenBucket(self.user_rate, self.user_burst)
+                self._user_buckets[user_id] = user_bucket
+
+            user_bucket.refill(now)
+            self.global_bucket.refill(now)
+
+            if user_bucket.tokens < tokens:
+                metrics.increment(f'{self.name}_rate_limited_user')
+                return False, user_bucket.seconds_until_available(tokens)
+            if self.global_bucket.tokens < tokens:
+                metrics.increment(f'{self.name}_rate_limited_global')
+                return False, self.global_bucket.seconds_until_available(tokens)
+
+            user_bucket.tokens -= tokens
+            self.global_bucket.tokens -= tokens
+            metrics.increment(f'{self.name}_allowed')
+            return True, 0.0
+
+def create_rate_limiter(name):
+    return RateLimiter(
+        name,
+        user_rate=RATE_LIMIT_USER_PER_MINUTE / 60,
+        user_burst=RATE_LIMIT_USER_BURST,
+        global_rate=RATE_LIMIT_GLOBAL_PER_SECOND,
+        global_burst=RATE_LIMIT_GLOBAL_BURST
+    )
+
+rate_limiters = {
+    'log_meal': create_rate_limiter('log_meal'),
+    'analytics': create_rate_limiter('analytics')
+}
+
+def rate_limit_identity(verified_uid=None):
+    """
+    Key for the per-user bucket: the verified Firebase uid, else the client address.
+    User ids from the request body or path are caller-controlled, so keying on them
+    would let a burst rotate ids and skip the per-user limit.
+    """
+    if verified_uid:
+        return verified_uid
+    return f"ip:{request.remote_addr}"
+
+def check_rate_limit(endpoint, identity, cost=1):
+    """Return a 429 response if the caller or the endpoint as a whole is over its limit, else None"""
+    allowed, retry_after = rate_limiters[endpoint].acquire(identity, cost)
+    if allowed:
+        return None
+    response = jsonify({'error': 'Rate limit exceeded', 'retry_after': round(retry_after, 1)})
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response, 429
+
+# Shared across requests so concurrent lookups of the same food issue one BigQuery job
+nutrition_lookups = SingleFlight('nutrition_lookup')
+
 class BigQueryNutritionClient:
     def __init__(self):
         self.client = bigquery.Client()
-        self.project_id = "nutrition-463318"  # TODO: Replace with your GCP project ID
-        self.dataset_id = "nutrition_data"   # TODO: Replace with your dataset name
+        self.project_id = BIGQUERY_PROJECT_ID
+        self.dataset_id = BIGQUERY_DATASET_ID
         self.table_id = "nutrient_table"              # TODO: Replace with your table name
 
     def get_nutrition_info(self, food_query):
-        cleaned_query = re.sub(r'\\d+', '', food_query).strip().lower()
+        # Callers pass the food name without its quantity; digits that are part
+        # of the name (7up, v8) are kept
+        cleaned_query = ' '.join(food_query.lower().split())
+        metrics.increment('nutrition_lookup_requests')
+        return nutrition_lookups.do(
+            cleaned_query,
+            lambda: self._query_nutrition_info(food_query, cleaned_query)
+        )
+
+    def _query_nutrition_info(self, food_query, cleaned_query):
         print(f"Querying BigQuery for: '%{cleaned_query}%'")  # Debug print
 
         query = f"""
@@ -127,7 +401,7 @@ class FoodParser:
             'sugar': 0
         }
         for item in food_items:
-            nutrition_data = self.nutrition_client.get_nutrition_info(item['query'])
+            nutrition_data = self.nutrition_client.get_nutrition_info(item['food_name'])
             if nutrition_data and 'totalNutrients' in nutrition_data:
                 nutrients = nutrition_data['totalNutrients']
                 item_nutrients = {
@@ -148,6 +422,220 @@ class FoodParser:
                 print(f"Skipping '{item['query']}' as it was not found in BigQuery.")
         return foods_with_nutrition, total_nutrients
 
+class MealHistoryWarehouse:
+    """Exports Firestore meals into BigQuery and runs historical aggregates against them"""
+    EXPORT_BATCH_SIZE = 500
+    NUTRIENTS = ['calories', 'protein', 'carbs', 'fat', 'fiber', 'sugar']
+
+    def __init__(self):
+        self.client = bigquery.Client()
+        self.project_id = BIGQUERY_PROJECT_ID
+        self.dataset_id = BIGQUERY_DATASET_ID
+        self.table_id = "meals_history"
+        self.schema = [
+            bigquery.SchemaField('meal_id', 'STRING', mode='REQUIRED'),
+            bigquery.SchemaField('user_id', 'STRING', mode='REQUIRED'),
+            bigquery.SchemaField('date', 'DATE', mode='REQUIRED'),
+            bigquery.SchemaField('created_at', 'TIMESTAMP'),
+        ] + [bigquery.SchemaField(nutrient, 'FLOAT64') for nutrient in self.NUTRIENTS]
+
+    @property
+    def table_ref(self):
+        return f"{self.project_id}.{self.dataset_id}.{self.table_id}"
+
+    def ensure_table(self):
+        """Create the meals history table, partitioned by date and clustered by user_id"""
+        table = bigquery.Table(self.table_ref, schema=self.schema)
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY,
+            field='date'
+        )
+        table.clustering_fields = ['user_id']
+        # Every analytics query must prune partitions instead of scanning full history
+        table.require_partition_filter = True
+        self.client.create_table(table, exists_ok=True)
+
+    def _meal_to_row(self, meal_id, meal_data):
+        meal_day = meal_data.get('day') or meal_data.get('date')
+        try:
+            meal_date = datetime.strptime(meal_day or '', '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            print(f"Skipping meal '{meal_id}' with invalid day: {meal_day}")
+            return None
+
+        row = {
+            'meal_id': meal_id,
+            'user_id': meal_data.get('user_id'),
+            'date': meal_date.isoformat(),
+            'created_at': meal_data['created_at'].isoformat() if meal_data.get('created_at') else None
+        }
+        nutrients = meal_data.get('total_nutrients', {})
+        for nutrient in self.NUTRIENTS:
+            try:
+                row[nutrient] = float(nutrients.get(nutrient, 0) or 0)
+            except (TypeError, ValueError):
+                row[nutrient] = 0.0
+        return row if row['user_id'] else None
+
+    def export_meals(self):
+        """
+        Copy meals created since the last export from Firestore into BigQuery.
+        Uses batch load jobs and a created_at watermark stored in Firestore.
+        Only meals older than ANALYTICS_EXPORT_LAG_SECONDS are exported, and the
+        watermark is inclusive, so rows may be exported twice (the analytics
+        query keeps one row per meal_id) but are never skipped.
+        Returns the number of exported rows.
+        """
+        if not db:
+            raise RuntimeError('Firestore not available')
+
+        self.ensure_table()
+        state_ref = db.collection('export_state').document('meals_bigquery')
+        state_doc = state_ref.get()
+        watermark = state_doc.to_dict().get('last_created_at') if state_doc.exists else None
+
+        job_config = bigquery.LoadJobConfig(
+            schema=self.schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+        cutoff = datetime.now(UTC) - timedelta(seconds=ANALYTICS_EXPORT_LAG_SECONDS)
+        query = db.collection('meals').where('created_at', '<=', cutoff)
+        if watermark:
+            query = query.where('created_at', '>=', watermark)
+        query = query.order_by('created_at').limit(self.EXPORT_BATCH_SIZE)
+
+        exported = 0
+        last_meal = None
+        while True:
+            # Page by document cursor so meals sharing a created_at are not dropped
+            page = query.start_after(last_meal) if last_meal else query
+            meals = list(page.stream())
+            if not meals:
+                break
+
+            rows = []
+            for meal in meals:
+                row = self._meal_to_row(meal.id, meal.to_dict())
+                if row:
+                    rows.append(row)
+            if rows:
+                self.client.load_table_from_json(rows, self.table_ref, job_config=job_config).result()
+                exported += len(rows)
+
+            # Advance the watermark only after the batch has been loaded
+            last_meal = meals[-1]
+            state_ref.set({'last_created_at': last_meal.to_dict()['created_at'], 'updated_at': datetime.utcnow()})
+
+            if len(meals) < self.EXPORT_BATCH_SIZE:
+                break
+
+        # Everything up to the cutoff is now in BigQuery
+        state_ref.set({'last_created_at': cutoff, 'updated_at': datetime.utcnow()})
+
+        print(f"Exported {exported} meals to BigQuery table {self.table_ref}")
+        return exported
+
+    def get_user_trends(self, user_id, start_date):
+        """
+        Monthly averages of daily intake and macro ratios for a user since start_date.
+        Aggregation runs in BigQuery; the row with month=None is the whole-window rollup.
+        """
+        averages = ',\n            '.join(
+            f"ROUND(AVG({nutrient}), 1) AS avg_{nutrient}" for nutrient in self.NUTRIENTS
+        )
+        daily_totals = ',\n                '.join(
+            f"SUM({nutrient}) AS {nutrient}" for nutrient in self.NUTRIENTS
+        )
+        query = f"""
+        WITH meals AS (
+            SELECT *
+            FROM `{self.table_ref}`
+            WHERE user_id = @user_id AND date >= @start_date
+            -- Exports are at-least-once; keep one row per meal
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY meal_id ORDER BY created_at) = 1
+        ),
+        daily AS (
+            SELECT
+                date,
+                {daily_totals}
+            FROM meals
+            GROUP BY date
+        ),
+        macro_energy AS (
+            SELECT
+                FORMAT_DATE('%Y-%m', date) AS month,
+                *,
+                protein * 4 + carbs * 4 + fat * 9 AS macro_calories
+            FROM daily
+        )
+        SELECT
+            month,
+            COUNT(*) AS days_logged,
+            {averages},
+            ROUND(SAFE_DIVIDE(SUM(protein * 4), SUM(macro_calories)), 3) AS protein_ratio,
+            ROUND(SAFE_DIVIDE(SUM(carbs * 4), SUM(macro_calories)), 3) AS carbs_ratio,
+            ROUND(SAFE_DIVIDE(SUM(fat * 9), SUM(macro_calories)), 3) AS fat_ratio
+        FROM macro_energy
+        GROUP BY ROLLUP(month)
+        ORDER BY month IS NULL, month
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("user_id", "STRING", user_id),
+                bigquery.ScalarQueryParameter("start_date", "DATE", start_date)
+            ]
+        )
+        rows = [dict(row) for row in self.client.query(query, job_config=job_config).result()]
+        monthly = [row for row in rows if row['month'] is not None]
+        overall = next((row for row in rows if row['month'] is None), None)
+        if overall:
+            overall.pop('month')
+        return monthly, overall
+
+class TTLCache:
+    """Small thread-safe in-process cache with per-entry expiry"""
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# Initialize BigQuery meal history warehouse
+try:
+    meal_warehouse = MealHistoryWarehouse()
+    print("BigQuery meal history warehouse initialized")
+except Exception as e:
+    print(f"BigQuery meal history warehouse initialization failed: {e}")
+    meal_warehouse = None
+
+# Cached analytics results keyed by (user_id, window, start_date)
+analytics_cache = TTLCache(ANALYTICS_CACHE_TTL_SECONDS)
+
+def export_meals_to_bigquery():
+    """Run the Firestore -> BigQuery meals export and drop stale analytics results"""
+    exported = meal_warehouse.export_meals()
+    if exported:
+        analytics_cache.clear()
+    return exported
+
 def verify_firebase_token(token):
     """Verify Firebase ID token and return user info"""
     if not firebase_admin:
@@ -165,8 +653,8 @@ def verify_firebase_token(token):
         print(f"Token verification failed: {e}")
         return None
 
-def get_or_create_user_profile(user_info):
-    """Get or create user profile in Firestore"""
+def get_or_create_user_profile(user_info, tz_name=None):
+    """Get or create user profile in Firestore, optionally recording the client's timezone"""
     if not db:
         return user_info
     
@@ -176,13 +664,17 @@ def get_or_create_user_profile(user_info):
         
         if user_doc.exists:
             # Update existing user profile
-            user_ref.update({
+            profile_update = {
                 'last_login': datetime.utcnow(),
                 'email': user_info.get('email'),
                 'name': user_info.get('name'),
                 'picture': user_info.get('picture')
-            })
-            return user_doc.to_dict()
+            }
+            if tz_name:
+                profile_update['timezone'] = tz_name
+                user_timezone_cache.set(user_info['uid'], tz_name)
+            user_ref.update(profile_update)
+            return dict(user_doc.to_dict(), **profile_update)
         else:
             # Create new user profile
             user_data = {
@@ -192,6 +684,7 @@ def get_or_create_user_profile(user_info):
                 'picture': user_info.get('picture', ''),
                 'created_at': datetime.utcnow(),
                 'last_login': datetime.utcnow(),
+                'timezone': tz_name or DEFAULT_TIMEZONE,
                 'nutrition_goals': {
                     'calories': 2000,
                     'protein': 100,
@@ -202,11 +695,62 @@ def get_or_create_user_profile(user_info):
                 }
             }
             user_ref.set(user_data)
+            user_timezone_cache.set(user_info['uid'], user_data['timezone'])
             return user_data
     except Exception as e:
         print(f"Error managing user profile: {e}")
         return user_info
 
+# Profile timezones, cached briefly to avoid a profile read on every meal request
+user_timezone_cache = TTLCache(300)
+
+def get_user_timezone(user_id):
+    """Return the timezone from the user's profile as a ZoneInfo, defaulting to UTC"""
+    tz_name = user_timezone_cache.get(user_id)
+    if tz_name is None:
+        tz_name = DEFAULT_TIMEZONE
+        if db:
+            try:
+                user_doc = db.collection('users').document(user_id).get()
+                if user_doc.exists:
+                    tz_name = user_doc.to_dict().get('timezone') or DEFAULT_TIMEZONE
+            except Exception as e:
+                print(f"Error fetching user timezone: {e}")
+        user_timezone_cache.set(user_id, tz_name)
+
+    try:
+        return ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return UTC
+
+def local_day(tz, when=None):
+    """User-local day key (YYYY-MM-DD) for a UTC timestamp, defaulting to now"""
+    return (when or datetime.now(UTC)).astimezone(tz).date().isoformat()
+
+def sum_meal_nutrients(user_id, day):
+    """Total nutrients over a user's meals on one user-local day"""
+    total_nutrients = {
+        'calories': 0,
+        'protein': 0,
+        'carbs': 0,
+        'fat': 0,
+        'fiber': 0,
+        'sugar': 0
+    }
+    for meal in build_meal_query('meals_for_day', user_id=user_id, day=day).stream():
+        meal_data = meal.to_dict()
+        if 'total_nutrients' in meal_data:
+            nutrients = meal_data['total_nutrients']
+            for nutrient in total_nutrients:
+                total_nutrients[nutrient] += nutrients.get(nutrient, 0)
+    return total_nutrients
+
+def requested_day(user_id):
+    """The `date` query param as a validated day key, defaulting to today in the user's timezone"""
+    if request.args.get('date'):
+        return parse_day(request.args['date'])
+    return local_day(get_user_timezone(user_id))
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -218,6 +762,14 @@ def health_check():
         'firestore_enabled': db is not None
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Request coalescing, rate limiting and cache counters"""
+    return jsonify({
+        'timestamp': datetime.utcnow().isoformat(),
+        'counters': metrics.snapshot()
+    })
+
 @app.route('/api/auth/verify', methods=['POST'])
 def verify_token():
     """Verify Firebase ID token and return user profile"""
@@ -232,8 +784,16 @@ def verify_token():
         if not user_info:
             return jsonify({'error': 'Invalid token'}), 401
         
+        # Clients send their IANA timezone so meal days follow the user's local calendar
+        tz_name = None
+        if data.get('timezone'):
+            try:
+                tz_name = ZoneInfo(data['timezone']).key
+            except (ZoneInfoNotFoundError, ValueError, TypeError):
+                return jsonify({'error': f"Unknown timezone: {data['timezone']}"}), 400
+        
         # Get or create user profile
-        user_profile = get_or_create_user_profile(user_info)
+        user_profile = get_or_create_user_profile(user_info, tz_name)
         
         return jsonify({
             'message': 'Token verified successfully',
@@ -310,6 +870,43 @@ def update_user_goals(uid):
         print(f"Error updating user goals: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/auth/user/<uid>/timezone', methods=['PUT'])
+def update_user_timezone(uid):
+    """Update the user's timezone (IANA name, e.g. Europe/Berlin)"""
+    try:
+        if not db:
+            return jsonify({'error': 'Firestore not available'}), 503
+        
+        data = request.get_json()
+        if not data or 'timezone' not in data:
+            return jsonify({'error': 'timezone is required'}), 400
+        
+        try:
+            tz_name = ZoneInfo(data['timezone']).key
+        except (ZoneInfoNotFoundError, ValueError, TypeError):
+            return jsonify({'error': f"Unknown timezone: {data['timezone']}"}), 400
+        
+        user_ref = db.collection('users').document(uid)
+        user_doc = user_ref.get()
+        
+        if not user_doc.exists:
+            return jsonify({'error': 'User not found'}), 404
+        
+        user_ref.update({
+            'timezone': tz_name,
+            'updated_at': datetime.utcnow()
+        })
+        user_timezone_cache.set(uid, tz_name)
+        
+        return jsonify({
+            'message': 'Timezone updated successfully',
+            'timezone': tz_name
+        })
+        
+    except Exception as e:
+        print(f"Error updating user timezone: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/api/log_meal', methods=['POST'])
 def log_meal():
     """Log a meal with nutrition data"""
@@ -323,12 +920,13 @@ def log_meal():
         # Check for Firebase authentication
         auth_header = request.headers.get('Authorization')
         user_id = None
+        verified_uid = None
         
         if auth_header and auth_header.startswith('Bearer '):
             token = auth_header.split(' ')[1]
             user_info = verify_firebase_token(token)
             if user_info:
-                user_id = user_info['uid']
+                user_id = verified_uid = user_info['uid']
                 # Get or create user profile
                 get_or_create_user_profile(user_info)
         
@@ -337,7 +935,6 @@ def log_meal():
             user_id = data.get('user_id')
         
         food_items = data.get('food_items')
-        meal_date = data.get('date', date.today().isoformat())
         
         if not user_id:
             return jsonify({'error': 'user_id is required or valid Firebase token must be provided'}), 400
@@ -345,20 +942,37 @@ def log_meal():
         if not food_items:
             return jsonify({'error': 'food_items is required'}), 400
         
-        # Parse food items and get nutrition data
+        # An explicit date is taken as the user-local day; otherwise derive it
+        # from the current UTC time in the user's profile timezone
+        user_timezone = get_user_timezone(user_id)
+        logged_at = datetime.now(UTC)
+        try:
+            meal_day = parse_day(data['date']) if data.get('date') else local_day(user_timezone, logged_at)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'date must be in YYYY-MM-DD format'}), 400
+        
+        # Parse food items and get nutrition data, charging one token per lookup
         parser = FoodParser()
         parsed_items = parser.parse_food_items(food_items)
+        if len(parsed_items) > MAX_FOOD_ITEMS_PER_MEAL:
+            return jsonify({'error': f'A meal can have at most {MAX_FOOD_ITEMS_PER_MEAL} food items'}), 400
+        
+        limited = check_rate_limit('log_meal', rate_limit_identity(verified_uid), cost=len(parsed_items))
+        if limited:
+            return limited
+        
         foods_with_nutrition, total_nutrients = parser.get_nutrition_for_items(parsed_items)
         
         # Create meal document
         meal_document = {
             'user_id': user_id,
-            'date': meal_date,
+            'day': meal_day,
+            'timezone': user_timezone.key,
             'food_items': food_items,
             'total_nutrients': total_nutrients,
             'foods': foods_with_nutrition,
-            'created_at': datetime.utcnow(),
-            'updated_at': datetime.utcnow()
+            'created_at': logged_at,
+            'updated_at': logged_at
         }
         
         # Store in Firestore
@@ -432,19 +1046,28 @@ def update_daily_summary(user_id, meal_date, nutrients):
 
 @app.route('/api/meals/<user_id>', methods=['GET'])
 def get_user_meals(user_id):
-    """Get meals for a specific user"""
+    """
+    Get meals for a specific user.
+    Query params: date (single day) or start/end (inclusive range of user-local days, YYYY-MM-DD)
+    """
     try:
-        date_filter = request.args.get('date')
+        try:
+            start = parse_day(request.args['start']) if request.args.get('start') else None
+            end = parse_day(request.args['end']) if request.args.get('end') else None
+            if request.args.get('date'):
+                start = end = parse_day(request.args['date'])
+        except ValueError:
+            return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
         
         if not db:
             return jsonify({'error': 'Firestore not available'}), 503
         
-        # Build query
-        query = db.collection('meals').where('user_id', '==', user_id)
-        if date_filter:
-            query = query.where('date', '==', date_filter)
+        if start or end:
+            query = build_meal_query('meals_in_day_range', user_id=user_id, start=start, end=end)
+        else:
+            query = build_meal_query('recent_meals', user_id=user_id)
         
-        meals_query = query.order_by('created_at', direction=firestore.Query.DESCENDING).get()
+        meals_query = query.get()
         meals = []
         
         # Convert Firestore documents to dictionaries
@@ -470,31 +1093,16 @@ def get_user_meals(user_id):
 def get_daily_summary(user_id):
     """Get daily nutrition summary for a user"""
     try:
-        summary_date = request.args.get('date', date.today().isoformat())
+        try:
+            summary_date = requested_day(user_id)
+        except ValueError:
+            return jsonify({'error': 'date must be in YYYY-MM-DD format'}), 400
         
         if not db:
             return jsonify({'error': 'Firestore not available'}), 503
         
-        # Calculate totals directly from meals collection for the specific date
-        meals_query = db.collection('meals').where('user_id', '==', user_id).where('date', '==', summary_date).get()
-        
-        # Initialize totals
-        total_nutrients = {
-            'calories': 0,
-            'protein': 0,
-            'carbs': 0,
-            'fat': 0,
-            'fiber': 0,
-            'sugar': 0
-        }
-        
-        # Sum up nutrients from all meals for the date
-        for meal in meals_query:
-            meal_data = meal.to_dict()
-            if 'total_nutrients' in meal_data:
-                nutrients = meal_data['total_nutrients']
-                for nutrient, value in total_nutrients.items():
-                    total_nutrients[nutrient] += nutrients.get(nutrient, 0)
+        # Calculate totals directly from meals collection for the user-local day
+        total_nutrients = sum_meal_nutrients(user_id, summary_date)
         
         return jsonify({
             'summary': total_nutrients,
@@ -513,11 +1121,15 @@ def nutrition_summary():
     Returns: total calories, protein, carbs, fat, fiber, sugar
     """
     user_id = request.args.get('user_id')
-    summary_date = request.args.get('date', date.today().isoformat())
 
     if not user_id:
         return jsonify({'error': 'user_id is required'}), 400
 
+    try:
+        summary_date = requested_day(user_id)
+    except ValueError:
+        return jsonify({'error': 'date must be in YYYY-MM-DD format'}), 400
+
     # If Firestore is not available, return empty data
     if not db:
         summary = {
@@ -531,25 +1143,8 @@ def nutrition_summary():
         return jsonify({'user_id': user_id, 'date': summary_date, 'summary': summary})
 
     try:
-        # Get all meals for the user on the specified date
-        meals_query = db.collection('meals').where('user_id', '==', user_id).where('date', '==', summary_date).get()
-        
-        # Calculate totals
-        total_nutrients = {
-            'calories': 0,
-            'protein': 0,
-            'carbs': 0,
-            'fat': 0,
-            'fiber': 0,
-            'sugar': 0,
-        }
-        
-        for meal in meals_query:
-            meal_data = meal.to_dict()
-            if 'total_nutrients' in meal_data:
-                nutrients = meal_data['total_nutrients']
-                for nutrient, value in total_nutrients.items():
-                    total_nutrients[nutrient] += nutrients.get(nutrient, 0)
+        # Total the user's meals on the specified user-local day
+        total_nutrients = sum_meal_nutrients(user_id, summary_date)
         
         return jsonify({'user_id': user_id, 'date': summary_date, 'summary': total_nutrients})
     except Exception as e:
@@ -573,11 +1168,15 @@ def recommend_next_meal():
     Returns: deficits and 2-3 food suggestions
     """
     user_id = request.args.get('user_id')
-    summary_date = request.args.get('date', date.today().isoformat())
 
     if not user_id:
         return jsonify({'error': 'user_id is required'}), 400
 
+    try:
+        summary_date = requested_day(user_id)
+    except ValueError:
+        return jsonify({'error': 'date must be in YYYY-MM-DD format'}), 400
+
     # User goals (could be fetched from DB in a real app)
     goals = {
         'calories': 2000,
@@ -614,23 +1213,7 @@ def recommend_next_meal():
         }
     else:
         try:
-            meals_query = db.collection('meals').where('user_id', '==', user_id).where('date', '==', summary_date).get()
-            
-            today_nutrients = {
-                'calories': 0,
-                'protein': 0,
-                'carbs': 0,
-                'fat': 0,
-                'fiber': 0,
-                'sugar': 0
-            }
-            
-            for meal in meals_query:
-                meal_data = meal.to_dict()
-                if 'total_nutrients' in meal_data:
-                    nutrients = meal_data['total_nutrients']
-                    for nutrient, value in today_nutrients.items():
-                        today_nutrients[nutrient] += nutrients.get(nutrient, 0)
+            today_nutrients = sum_meal_nutrients(user_id, summary_date)
         except Exception as e:
             print(f"Error fetching today's nutrients: {e}")
             today_nutrients = {
@@ -671,5 +1254,118 @@ def recommend_next_meal():
         'suggestions': suggested_foods
     })
 
+@app.route('/api/admin/meals-export', methods=['POST'])
+def export_meals_analytics():
+    """
+    Export new meals from Firestore into the BigQuery meals history table.
+    Intended to be triggered periodically (e.g. Cloud Scheduler) with the
+    X-Export-Token header set to ANALYTICS_EXPORT_TOKEN.
+    """
+    export_token = request.headers.get('X-Export-Token', '')
+    if not ANALYTICS_EXPORT_TOKEN or not hmac.compare_digest(export_token.encode(), ANALYTICS_EXPORT_TOKEN.encode()):
+        return jsonify({'error': 'Forbidden'}), 403
+
+    if not db or not meal_warehouse:
+        return jsonify({'error': 'Analytics export not available'}), 503
+
+    try:
+        exported = export_meals_to_bigquery()
+        return jsonify({'message': 'Meals exported successfully', 'exported': exported})
+    except Exception as e:
+        print(f"Error exporting meals: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.cli.command('export-meals')
+def export_meals_command():
+    """Export new meals from Firestore into BigQuery"""
+    if not db or not meal_warehouse:
+        print("Analytics export not available")
+        return
+    export_meals_to_bigquery()
+
+@app.route('/api/analytics/<user_id>', methods=['GET'])
+def get_user_analytics(user_id):
+    """
+    Get long-range nutrition trends for a user from the BigQuery meals history.
+    Query params: window (30d, 90d, 180d or 365d; default 365d)
+    Returns: monthly averages of daily intake, macro ratios and a whole-window rollup
+    Results are cached in-process per (user, window, start date). An export only
+    clears the cache of the process that ran it, so other workers can serve results
+    up to ANALYTICS_CACHE_TTL_SECONDS old after an export.
+    """
+    window = request.args.get('window', '365d')
+    if window not in ANALYTICS_WINDOWS:
+        return jsonify({'error': f"window must be one of: {', '.join(ANALYTICS_WINDOWS)}"}), 400
+
+    if not meal_warehouse:
+        return jsonify({'error': 'Analytics not available'}), 503
+
+    # start_date is part of the key so cached results roll over at the user's local midnight
+    today = date.fromisoformat(local_day(get_user_timezone(user_id)))
+    start_date = today - timedelta(days=ANALYTICS_WINDOWS[window])
+    cache_key = (user_id, window, start_date)
+    cached = analytics_cache.get(cache_key)
+    if cached:
+        metrics.increment('analytics_cache_hits')
+        return jsonify(dict(cached, cached=True))
+
+    # Only cache misses reach BigQuery, so only they count against the limit
+    limited = check_rate_limit('analytics', rate_limit_identity())
+    if limited:
+        return limited
+
+    metrics.increment('analytics_cache_misses')
+    try:
+        monthly, overall = meal_warehouse.get_user_trends(user_id, start_date)
+        result = {
+            'user_id': user_id,
+            'window': window,
+            'start_date': start_date.isoformat(),
+            'monthly': monthly,
+            'overall': overall
+        }
+        analytics_cache.set(cache_key, result)
+        return jsonify(dict(result, cached=False))
+
+    except Exception as e:
+        print(f"Error fetching analytics: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.cli.command('firestore-indexes')
+@click.option('--check', is_flag=True, help='Fail if firestore.indexes.json is out of date instead of writing it')
+def firestore_indexes_command(check):
+    """Generate firestore.indexes.json from MEAL_QUERIES"""
+    config = json.dumps(firestore_index_config(), indent=2) + '\n'
+    if check:
+        existing = open(FIRESTORE_INDEXES_PATH).read() if os.path.exists(FIRESTORE_INDEXES_PATH) else ''
+        if existing != config:
+            raise click.ClickException('firestore.indexes.json is out of date; run `flask firestore-indexes`')
+        print("firestore.indexes.json is up to date")
+        return
+    with open(FIRESTORE_INDEXES_PATH, 'w') as f:
+        f.write(config)
+    print(f"Wrote {FIRESTORE_INDEXES_PATH}")
+
+@app.cli.command('backfill-meal-days')
+def backfill_meal_days_command():
+    """Copy the legacy `date` field into `day` on meals logged before day keys existed"""
+    if not db:
+        print("Firestore not available")
+        return
+    updated = 0
+    batch = db.batch()
+    for meal in db.collection('meals').stream():
+        meal_data = meal.to_dict()
+        if meal_data.get('day') or not meal_data.get('date'):
+            continue
+        batch.update(meal.reference, {'day': meal_data['date'], 'timezone': DEFAULT_TIMEZONE})
+        updated += 1
+        # Firestore batches are limited to 500 writes
+        if updated % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    print(f"Backfilled day on {updated} meals")
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
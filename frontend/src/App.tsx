@@ -37,7 +37,8 @@ interface FoodItem {
 interface Meal {
   _id: string
   user_id: string
-  date: string
+  day: string
+  timezone: string
   food_items: string
   total_nutrients: NutritionData
   foods: FoodItem[]
@@ -9,6 +9,7 @@ import {
   signInWithPopup
 } from 'firebase/auth';
 import { auth } from '../firebase';
+import { apiService } from '../services/api';
 import toast from 'react-hot-toast';
 
 interface AuthContextType {
@@ -36,7 +37,17 @@ export function AuthProvider({ children }: { children: React.ReactNode }) {
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
-    const unsubscribe = onAuthStateChanged(auth, (user) => {
+    const unsubscribe = onAuthStateChanged(auth, async (user) => {
+      if (user) {
+        // Record the browser's timezone on the profile before the app loads, so
+        // the backend's default meal day matches the user's local day
+        try {
+          const token = await user.getIdToken();
+          await apiService.verifyToken(token, Intl.DateTimeFormat().resolvedOptions().timeZone);
+        } catch (error) {
+          console.error('Error syncing user profile:', error);
+        }
+      }
       setCurrentUser(user);
       setLoading(false);
     });
@@ -47,8 +47,8 @@ api.interceptors.response.use(
 // API functions
 export const apiService = {
   // Auth endpoints
-  verifyToken: (token: string) => 
-    api.post('/auth/verify', { token }),
+  verifyToken: (token: string, timezone?: string) => 
+    api.post('/auth/verify', { token, timezone }),
 
   getUserProfile: (uid: string) => 
     api.get(`/auth/user/${uid}`),
@@ -63,6 +63,9 @@ export const apiService = {
   getUserMeals: (userId: string, date?: string) => 
     api.get(`/meals/${userId}`, { params: { date } }),
 
+  getUserMealsInRange: (userId: string, start: string, end: string) => 
+    api.get(`/meals/${userId}`, { params: { start, end } }),
+
   getDailySummary: (userId: string, date?: string) => 
     api.get(`/summary/${userId}`, { params: { date } }),
 
@@ -72,6 +75,10 @@ export const apiService = {
   getMealRecommendations: (userId: string, date?: string) => 
     api.get('/recommend_next_meal', { params: { user_id: userId, date } }),
 
+  // Analytics endpoints
+  getUserAnalytics: (userId: string, window?: string) => 
+    api.get(`/analytics/${userId}`, { params: { window } }),
+
   // Health check
   healthCheck: () => 
     api.get('/health'),